@@ -2,15 +2,24 @@
 from __future__ import annotations
 
 import os
-import json
+import re
+import time
+import shutil
 import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from functools import partial
 
+import orjson
 import pandas as pd
 import requests
 from airflow.decorators import dag, task
 from airflow.exceptions import AirflowFailException
+from airflow.operators.python import get_current_context
 from pendulum import timezone
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 SAO_PAULO_TZ = timezone("America/Sao_Paulo")
 
@@ -20,12 +29,130 @@ API_BASE = "http://api.aviationstack.com/v1/flights"
 LIMIT = 100                       # plan free limit per request
 MAX_PAGES = 5                     # safety limit to avoid infinite pagination
 OUTPUT_DIR = "/opt/airflow/data"  # mounted volume
-OUTPUT_FILE = "Departures.csv"
+OUTPUT_FILE = "Departures.parquet"
+EXTRACT_DIR = os.path.join(OUTPUT_DIR, ".extract")  # scratch space for raw records (not user output)
+EXTRACT_CACHE_TTL = timedelta(hours=6)  # max age of a run's cached pages / scratch entries
+HTTP_POOL_SIZE = 4                # pooled keep-alive connections / concurrent page fetches
+
+
+def _flatten(d: dict, out: dict, prefix: str = "") -> dict:
+    """
+    Flattens nested dicts into dotted keys (same naming as pd.json_normalize).
+    Lists are kept as leaf values; only dicts are walked.
+    """
+    for key, value in d.items():
+        if isinstance(value, dict):
+            _flatten(value, out, f"{prefix}{key}.")
+        else:
+            out[prefix + key] = value
+    return out
+
+
+def _write_json_atomic(path: str, obj) -> None:
+    """
+    Writes obj as JSON through a uniquely named temp file in the same directory,
+    so concurrent runs never share a temp file and readers never see a partial file.
+    """
+    with tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(path), suffix=".tmp", delete=False
+    ) as f:
+        f.write(orjson.dumps(obj))
+    os.replace(f.name, path)
+
+
+def _cache_age(path: str) -> float | None:
+    """Returns the age in seconds of a cached file, or None if missing or older than EXTRACT_CACHE_TTL."""
+    try:
+        age = time.time() - os.path.getmtime(path)
+    except FileNotFoundError:
+        return None
+    return age if age < EXTRACT_CACHE_TTL.total_seconds() else None
+
+
+def _prune_extract_dir(keep: str) -> None:
+    """Removes scratch entries in EXTRACT_DIR older than EXTRACT_CACHE_TTL, except `keep`."""
+    cutoff = time.time() - EXTRACT_CACHE_TTL.total_seconds()
+    for name in os.listdir(EXTRACT_DIR):
+        path = os.path.join(EXTRACT_DIR, name)
+        try:
+            if path == keep or os.path.getmtime(path) >= cutoff:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            continue  # already removed by a concurrent run
+        logging.info("Removed old extract scratch entry: %s", path)
+
+
+def _build_session() -> requests.Session:
+    """
+    Returns a Session that reuses keep-alive connections across pages and
+    retries transient failures (rate limit / 5xx) with backoff.
+
+    HTTP/2 multiplexing (e.g. httpx) is not used: API_BASE is plain http on the
+    free plan and h2 is only negotiated over TLS, so requests would stay on
+    HTTP/1.1 anyway. Concurrency comes from the pooled connections instead.
+    """
+    retry = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        raise_on_status=False,  # let the status check in _fetch_page report the error
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _fetch_page(session: requests.Session, api_key: str, offset: int) -> dict:
+    """Fetches a single page at the given offset and validates the payload shape."""
+    params = {
+        "access_key": api_key,
+        "dep_iata": DEP_IATA,
+        "limit": LIMIT,
+        "offset": offset,
+    }
+    resp = session.get(API_BASE, params=params, timeout=60)
+    logging.info("Request URL: %s", resp.url)
+    if resp.status_code != 200:
+        raise AirflowFailException(
+            f"HTTP {resp.status_code}: {resp.text[:300]}"
+        )
+
+    payload = orjson.loads(resp.content)
+    if "data" not in payload or not isinstance(payload["data"], list):
+        raise AirflowFailException(
+            f"Unexpected API response: {str(payload)[:500]}"
+        )
+    return payload
+
+
+def _fetch_page_cached(
+    session: requests.Session, api_key: str, pages_dir: str, offset: int
+) -> dict:
+    """
+    Like _fetch_page, but each page is saved to pages_dir as it arrives, so a retry
+    of the same run only requests the pages a failed attempt did not get.
+    """
+    page_path = os.path.join(pages_dir, f"page_{offset}.json")
+    age = _cache_age(page_path)
+    if age is not None:
+        logging.info("Reusing cached page at offset %s (%.0f min old)", offset, age / 60)
+        with open(page_path, "rb") as f:
+            return orjson.loads(f.read())
+
+    payload = _fetch_page(session, api_key, offset)
+    _write_json_atomic(page_path, payload)
+    return payload
 
 
 @dag(
     dag_id="aviationstack_departures_gig",
-    description="Extract GIG departures from Aviationstack, transform with pandas, and save CSV.",
+    description="Extract GIG departures from Aviationstack, transform with pandas, and save Parquet.",
     # Use a fixed start_date; catchup disabled for simplicity
     start_date=datetime(2025, 9, 1, tzinfo=SAO_PAULO_TZ),
     schedule="0 6 * * *",  # every day at 06:00 (America/Sao_Paulo)
@@ -39,12 +166,22 @@ OUTPUT_FILE = "Departures.csv"
 )
 def aviationstack_departures_gig():
     @task
-    def extract() -> list[dict]:
+    def extract() -> str:
         """
-        Fetches paginated responses from Aviationstack using simple offset-based pagination.
+        Fetches paginated responses from Aviationstack using offset-based pagination.
+        The first page is fetched alone; the remaining offsets (from its pagination
+        total, capped at MAX_PAGES) are fetched concurrently. If the response has no
+        total, pages are fetched one by one until a short page.
+        Returns the path of the JSON file holding the raw records.
 
         Notes:
         - API key is read from environment variable 'AVIATIONSTACK_API_KEY'.
+        - A single pooled Session is reused for all pages (keep-alive + retries).
+        - Each page is cached in EXTRACT_DIR per run_id as it arrives, so a retry of
+          a failed attempt only requests the missing pages (rate-limited API).
+        - Raw records are written per run_id to EXTRACT_DIR and handed to transform
+          by path, keeping them out of XCom. Entries older than EXTRACT_CACHE_TTL
+          are pruned at the end of each run.
         """
         api_key = os.getenv("AVIATIONSTACK_API_KEY")
         if not api_key:
@@ -52,119 +189,110 @@ def aviationstack_departures_gig():
                 "Missing API key. Set 'AVIATIONSTACK_API_KEY' in the environment."
             )
 
+        # Keyed on run_id: retries and task clears of this run reuse the cache,
+        # while a new run (scheduled or manual) always fetches live data
+        run_key = re.sub(r"[^\w.-]", "_", get_current_context()["run_id"])
+        records_path = os.path.join(EXTRACT_DIR, f"{run_key}.json")
+        pages_dir = os.path.join(EXTRACT_DIR, run_key)
+
+        age = _cache_age(records_path)
+        if age is not None:
+            logging.info("Reusing extract of this run: %s (%.0f min old)", records_path, age / 60)
+            return records_path
+
+        os.makedirs(pages_dir, exist_ok=True)
         all_records: list[dict] = []
-        offset = 0
-        pages = 0
-
-        while pages < MAX_PAGES:
-            params = {
-                "access_key": api_key,
-                "dep_iata": DEP_IATA,
-                "limit": LIMIT,
-                "offset": offset,
-            }
-            resp = requests.get(API_BASE, params=params, timeout=60)
-            logging.info("Request URL: %s", resp.url)
-            if resp.status_code != 200:
-                raise AirflowFailException(
-                    f"HTTP {resp.status_code}: {resp.text[:300]}"
-                )
-
-            payload = resp.json()
-            if "data" not in payload or not isinstance(payload["data"], list):
-                raise AirflowFailException(
-                    f"Unexpected API response: {json.dumps(payload)[:500]}"
-                )
 
-            batch = payload["data"]
-            logging.info("Page %s: %s records", pages + 1, len(batch))
-            if not batch:
-                break
+        with _build_session() as session:
+            fetch = partial(_fetch_page_cached, session, api_key, pages_dir)
 
+            # Probe the first page; its pagination total tells us the remaining offsets
+            payload = fetch(0)
+            batch = payload["data"]
+            logging.info("Page 1: %s records", len(batch))
             all_records.extend(batch)
 
-            # Stop when we receive a short page (last page)
-            if len(batch) < LIMIT:
-                break
+            # A short page means there is nothing left to fetch
+            total = (payload.get("pagination") or {}).get("total")
+            if len(batch) == LIMIT and total is not None:
+                offsets = range(LIMIT, min(int(total), MAX_PAGES * LIMIT), LIMIT)
 
-            pages += 1
-            offset += LIMIT
+                # Pages are independent, so fetch them concurrently; map() keeps them in order
+                with ThreadPoolExecutor(max_workers=HTTP_POOL_SIZE) as pool:
+                    for page, payload in enumerate(pool.map(fetch, offsets), start=2):
+                        batch = payload["data"]
+                        logging.info("Page %s: %s records", page, len(batch))
+                        all_records.extend(batch)
+            elif len(batch) == LIMIT:
+                # Without a total we can't know which offsets hold data; every request
+                # counts against the plan quota, so go one page at a time instead
+                logging.warning("No pagination total in response; fetching pages sequentially.")
+                for page in range(2, MAX_PAGES + 1):
+                    batch = fetch((page - 1) * LIMIT)["data"]
+                    logging.info("Page %s: %s records", page, len(batch))
+                    all_records.extend(batch)
+
+                    # Stop when we receive a short page (last page)
+                    if len(batch) < LIMIT:
+                        break
 
         if not all_records:
             raise AirflowFailException("API returned no data.")
-        return all_records
+
+        _write_json_atomic(records_path, all_records)
+        logging.info("Extract written: %s (%s records)", records_path, len(all_records))
+        shutil.rmtree(pages_dir, ignore_errors=True)
+        _prune_extract_dir(keep=records_path)
+        return records_path
 
     @task
-    def transform(records: list[dict]) -> str:
+    def transform(records_path: str) -> str:
         """
-        Normalizes nested JSON to a pandas DataFrame, performs codeshare mapping,
-        builds date/time columns, selects final columns, and writes CSV.
-        Returns the CSV file path.
+        Splits codeshare listings from operated flights, normalizes the operated
+        flights to a pandas DataFrame, performs codeshare mapping, builds date/time
+        columns, selects final columns, and writes Parquet.
+        Returns the Parquet file path.
         """
-        # --- Normalize nested JSON ---
-        df = pd.json_normalize(records)
-
-        logging.info("Columns: %s", list(df.columns))
-        if "flight_status" in df.columns:
-            logging.info("Unique flight_status: %s", df["flight_status"].unique())
-
-        # --- Codeshare mapping ---
-        # Build a map from operated flight (flight.icao) -> "Airline / Flight Number" partners
-        if "flight.codeshared.flight_icao" in df.columns:
-            ref = (
-                df.loc[
-                    df["flight.codeshared.flight_icao"].notna(),
-                    ["flight.codeshared.flight_icao", "airline.name", "flight.number"],
-                ]
-                .copy()
-            )
-            ref["pair"] = (
-                ref["airline.name"].fillna("").astype(str)
-                + " "
-                + ref["flight.number"].astype(str)
+        if not os.path.exists(records_path):
+            raise AirflowFailException(
+                f"Extract output {records_path} no longer exists; clear 'extract' as well."
             )
+        with open(records_path, "rb") as f:
+            records = orjson.loads(f.read())
 
-            agg = (
-                ref.groupby(ref["flight.codeshared.flight_icao"].astype(str).str.upper())["pair"]
-                .apply(lambda s: " / ".join(sorted(set(s))))
-                .reset_index()
-                .rename(columns={"flight.codeshared.flight_icao": "flight.icao", "pair": "codeshare"})
+        # --- Split codeshare listings from operated flights ---
+        # Codeshare rows are only used to build the partner map and are dropped later,
+        # so aggregate them in plain Python and keep them out of the DataFrame.
+        operated: list[dict] = []
+        buckets: dict[str, set[str]] = {}
+        for r in records:
+            flight = r.get("flight") or {}
+            codeshared_icao = (flight.get("codeshared") or {}).get("flight_icao")
+            if codeshared_icao is None:
+                # Flatten right away so the nested dicts can be freed with `records`
+                operated.append(_flatten(r, {}))
+                continue
+            airline = (r.get("airline") or {}).get("name") or ""
+            buckets.setdefault(str(codeshared_icao).upper(), set()).add(
+                f"{airline} {flight.get('number')}"
             )
 
-            if "flight.icao" in df.columns:
-                df["flight.icao"] = df["flight.icao"].astype(str).str.upper()
-                df = df.merge(agg, how="left", on="flight.icao")
-                # Keep 'codeshare' only on operated flights (where codeshared is null)
-                df.loc[df["flight.codeshared.flight_icao"].notna(), "codeshare"] = pd.NA
-            else:
-                logging.warning("Missing 'flight.icao'; codeshare merge skipped.")
-        else:
-            logging.warning("Missing 'flight.codeshared.flight_icao'; codeshare mapping skipped.")
+        # Map from operated flight (flight.icao) -> "Airline / Flight Number" partners
+        codeshare_map = {key: " / ".join(sorted(pairs)) for key, pairs in buckets.items()}
+        logging.info(
+            "Records: %s operated, %s codeshare listings", len(operated), len(records) - len(operated)
+        )
+        del records
 
-        # --- Handling null values ---
-        if "codeshare" in df.columns:
-            before = len(df)
-            df = df.dropna(subset=["codeshare"])
-            logging.info("Filtered by non-null codeshare: %s -> %s rows", before, len(df))
-        else:
-            logging.warning("'codeshare' not found; skipping null filter.")
+        # --- Normalize nested JSON ---
+        # Pre-flattened dicts are much cheaper to load than pd.json_normalize
+        df = pd.DataFrame(operated)
 
-        # --- Datetime conversions and split into date/time columns ---
-        for col in ["departure.scheduled", "departure.estimated", "departure.actual"]:
-            if col in df.columns:
-                df[col] = pd.to_datetime(df[col], errors="coerce")
-
-        if "departure.scheduled" in df.columns:
-            df["scheduled_date"] = df["departure.scheduled"].dt.date
-            df["scheduled_time"] = df["departure.scheduled"].dt.time
-        if "departure.estimated" in df.columns:
-            df["estimated_date"] = df["departure.estimated"].dt.date
-            df["estimated_time"] = df["departure.estimated"].dt.time
-        if "departure.actual" in df.columns:
-            df["actual_date"] = df["departure.actual"].dt.date
-            df["actual_time"] = df["departure.actual"].dt.time
-
-        # --- Final column selection (Departure related) ---
+        logging.info("Columns: %s", list(df.columns))
+        if "flight_status" in df.columns:
+            logging.info("Unique flight_status: %s", df["flight_status"].unique())
+
+        # --- Output columns (Departure related) ---
         columns_to_keep = [
             "flight_status",
             "departure.airport",
@@ -191,29 +319,73 @@ def aviationstack_departures_gig():
             "actual_date",
             "actual_time",
         ]
+
+        # Project early so every later step works on a narrow frame
+        # (the departure.* timestamps are only needed to derive the date/time columns)
+        needed = set(columns_to_keep) | {
+            "departure.scheduled",
+            "departure.estimated",
+            "departure.actual",
+        }
+        df = df.drop(columns=[c for c in df.columns if c not in needed])
+
+        # --- Codeshare mapping ---
+        if not codeshare_map:
+            logging.warning("No codeshare listings found; codeshare mapping skipped.")
+        elif "flight.icao" in df.columns:
+            # Single pass: upper-case only the lookup key, so flight.icao is written
+            # as returned by the API and the column is never rewritten
+            df["codeshare"] = [
+                codeshare_map.get(v.upper()) if isinstance(v, str) else None
+                for v in df["flight.icao"]
+            ]
+        else:
+            logging.warning("Missing 'flight.icao'; codeshare lookup skipped.")
+
+        # --- Handling null values ---
+        if "codeshare" in df.columns:
+            before = len(df)
+            df = df.dropna(subset=["codeshare"])
+            logging.info("Filtered by non-null codeshare: %s -> %s rows", before, len(df))
+        else:
+            logging.warning("'codeshare' not found; skipping null filter.")
+
+        # --- Datetime conversions and split into date/time columns ---
+        # Parse once per column; date/time parts are stored as plain strings
+        for name in ["scheduled", "estimated", "actual"]:
+            col = f"departure.{name}"
+            if col in df.columns:
+                dt = pd.to_datetime(df[col], errors="coerce")
+                df[f"{name}_date"] = dt.dt.strftime("%Y-%m-%d")
+                df[f"{name}_time"] = dt.dt.strftime("%H:%M:%S")
+
+        # --- Final column selection ---
         keep = [c for c in columns_to_keep if c in df.columns]
         missing = [c for c in columns_to_keep if c not in df.columns]
         if missing:
             logging.warning("Missing columns: %s", missing)
 
-        df = df[keep].reset_index(drop=True)
+        # No reset_index(): the index is never written, so re-numbering is just a copy
+        df = df[keep]
 
-        # --- Write CSV ---
+        # --- Write Parquet ---
         os.makedirs(OUTPUT_DIR, exist_ok=True)
         out_path = os.path.join(OUTPUT_DIR, OUTPUT_FILE)
-        df.to_csv(out_path, index=False)
-        logging.info("CSV written: %s (rows=%s, cols=%s)", out_path, len(df), len(df.columns))
+        # Snappy Parquet is far smaller and faster to write than CSV; low-cardinality
+        # columns (airline, airport, status) get dictionary-encoded automatically
+        df.to_parquet(out_path, engine="pyarrow", compression="snappy", index=False)
+        logging.info("Parquet written: %s (rows=%s, cols=%s)", out_path, len(df), len(df.columns))
         return out_path
 
     @task
-    def load(csv_path: str):
-        """Logs the final CSV path for visibility."""
-        logging.info("Pipeline finished. Output: %s", csv_path)
+    def load(output_path: str):
+        """Logs the final output path for visibility."""
+        logging.info("Pipeline finished. Output: %s", output_path)
 
     # Orchestration
-    records = extract()
-    csv_path = transform(records)
-    load(csv_path)
+    records_path = extract()
+    output_path = transform(records_path)
+    load(output_path)
 
 
 _ = aviationstack_departures_gig()